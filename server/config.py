@@ -4,7 +4,14 @@ import os
 INDEX_DIR_ENV = 'INDEX_DIR'
 TRANSCRIPTS_DIR_ENV = 'TRANSCRIPTS_DIR'
 UPLOAD_DIR_ENV = 'UPLOAD_DIR'
+# The uploads directory used to be read from this variable, and named after
+# it by default, so both are still honored.
+LEGACY_UPLOADS_DIR_ENV = 'UPLOADS_DIR'
 RECORDINGS_DIR_ENV = 'RECORDINGS_DIR'
+WHISPER_MODELS_DIR_ENV = 'WHISPER_MODELS_DIR'
+
+# The working directory is resolved once, when this module is loaded.
+_CWD = os.getcwd()
 
 
 class Config:
@@ -13,42 +20,77 @@ class Config:
     _daily_api_url: str = None
     _deepgram_api_key: str = None
     _deepgram_model_name: str = None
+    _whisper_backend: str = None
+    _whisper_model_name: str = None
+    _whisper_device: str = None
+    _whisper_compute_type: str = None
+    _embed_compile: bool = False
+    _whisper_warmup: bool = False
+    _whisper_compile: bool = False
+    _whisper_trim_silence: bool = False
 
     _index_dir_path: str = None
     _transcripts_dir_path: str = None
     _uploads_dir_path: str = None
     _recordings_dir_path: str = None
+    _whisper_models_dir_path: str = None
+
+    _transcript_file_path_fmt: str = None
 
     def __init__(self, daily_api_key=os.getenv("DAILY_API_KEY"),
                  daily_api_url=os.getenv("DAILY_API_URL"),
                  deepgram_api_key=os.getenv("DEEPGRAM_API_KEY"),
                  deepgram_model_name=os.getenv("DEEPGRAM_MODEL_NAME"),
+                 whisper_backend=os.getenv("WHISPER_BACKEND"),
+                 whisper_model_name=os.getenv("WHISPER_MODEL_NAME"),
+                 whisper_device=os.getenv("WHISPER_DEVICE"),
+                 whisper_compute_type=os.getenv("WHISPER_COMPUTE_TYPE"),
+                 embed_compile=os.getenv("EMBED_COMPILE"),
+                 whisper_warmup=os.getenv("WHISPER_WARMUP"),
+                 whisper_compile=os.getenv("WHISPER_COMPILE"),
+                 whisper_trim_silence=os.getenv("WHISPER_TRIM_SILENCE"),
                  index_dir=None,
                  transcripts_dir=None,
                  uploads_dir=None,
-                 recordings_dir=None
+                 recordings_dir=None,
+                 whisper_models_dir=None
                  ):
 
         self._daily_api_key = daily_api_key
         self._daily_api_url = daily_api_url
         self._deepgram_api_key = deepgram_api_key
         self._deepgram_model_name = deepgram_model_name
-
-        if not index_dir:
-            self._index_dir_path = os.path.abspath(
-                deduce_dir_name("INDEX_DIR"))
-
-        if not transcripts_dir:
-            self._transcripts_dir_path = os.path.abspath(
-                deduce_dir_name("TRANSCRIPTS_DIR"))
-
-        if not uploads_dir:
-            self._uploads_dir_path = os.path.abspath(
-                deduce_dir_name("UPLOADS_DIR"))
-
-        if not recordings_dir:
-            self._recordings_dir_path = os.path.abspath(
-                deduce_dir_name("RECORDINGS_DIR"))
+        self._whisper_backend = whisper_backend
+        self._whisper_model_name = whisper_model_name
+        self._whisper_device = whisper_device
+        self._whisper_compute_type = whisper_compute_type
+        self._embed_compile = is_truthy(embed_compile)
+        self._whisper_warmup = is_truthy(whisper_warmup)
+        self._whisper_compile = is_truthy(whisper_compile)
+        self._whisper_trim_silence = is_truthy(whisper_trim_silence)
+
+        # Resolve directory paths once; the environment does not change
+        # after process start.
+        self._index_dir_path = resolve_dir_path(
+            index_dir or deduce_dir_name(INDEX_DIR_ENV))
+        self._transcripts_dir_path = resolve_dir_path(
+            transcripts_dir or deduce_dir_name(TRANSCRIPTS_DIR_ENV))
+        self._uploads_dir_path = resolve_dir_path(
+            uploads_dir or os.getenv(UPLOAD_DIR_ENV)
+            or deduce_dir_name(LEGACY_UPLOADS_DIR_ENV))
+        self._recordings_dir_path = resolve_dir_path(
+            recordings_dir or deduce_dir_name(RECORDINGS_DIR_ENV))
+        # Converting Whisper models is opt-in, so there is no default
+        # models directory.
+        whisper_models_dir = whisper_models_dir or os.getenv(
+            WHISPER_MODELS_DIR_ENV)
+        if whisper_models_dir:
+            self._whisper_models_dir_path = resolve_dir_path(
+                whisper_models_dir)
+
+        # Pre-join the per-file path template used for every transcript.
+        self._transcript_file_path_fmt = os.path.join(
+            escape_format(self._transcripts_dir_path), "{}.txt")
 
     def ensure_dirs(self):
         """Creates required file directories if they do not already exist."""
@@ -56,6 +98,8 @@ class Config:
         ensure_dir(self._recordings_dir_path)
         ensure_dir(self._uploads_dir_path)
         ensure_dir(self._index_dir_path)
+        if self._whisper_models_dir_path:
+            ensure_dir(self._whisper_models_dir_path)
 
     @property
     def daily_api_key(self) -> str:
@@ -73,6 +117,38 @@ class Config:
     def deepgram_model_name(self) -> str:
         return self._deepgram_model_name
 
+    @property
+    def whisper_backend(self) -> str:
+        return self._whisper_backend
+
+    @property
+    def whisper_model_name(self) -> str:
+        return self._whisper_model_name
+
+    @property
+    def whisper_device(self) -> str:
+        return self._whisper_device
+
+    @property
+    def whisper_compute_type(self) -> str:
+        return self._whisper_compute_type
+
+    @property
+    def whisper_warmup(self) -> bool:
+        return self._whisper_warmup
+
+    @property
+    def whisper_compile(self) -> bool:
+        return self._whisper_compile
+
+    @property
+    def whisper_trim_silence(self) -> bool:
+        return self._whisper_trim_silence
+
+    @property
+    def embed_compile(self) -> bool:
+        return self._embed_compile
+
     @property
     def transcripts_dir_path(self) -> str:
         """Returns transcript directory path."""
@@ -93,19 +169,52 @@ class Config:
         """Returns transcript directory path."""
         return self._recordings_dir_path
 
+    @property
+    def whisper_models_dir_path(self) -> str:
+        """Returns the directory path of converted Whisper models, or None
+        if models should not be converted."""
+        return self._whisper_models_dir_path
+
+    @property
+    def audio_hashes_file_path(self) -> str:
+        """Returns the path of the file mapping audio content hashes
+        to transcripts."""
+        return os.path.join(self._index_dir_path, "audio_hashes.json")
+
+    @property
+    def embedding_cache_file_path(self) -> str:
+        """Returns the path of the chunk embedding cache database."""
+        return os.path.join(self._index_dir_path, "embedding_cache.sqlite3")
+
     def get_transcript_file_path(self, file_name: str) -> str:
         """Returns the destination file path of the transcript file"""
-        return os.path.join(self.transcripts_dir_path, f"{file_name}.txt")
-
-    def get_remote_recording_audio_path(self, file_name: str) -> str:
-        """Returns audio path for remote Daily recording"""
-        return os.path.join(self.recordings_dir_path, f"{file_name}.wav")
+        return self._transcript_file_path_fmt.format(file_name)
 
 
 def ensure_dir(dir_path: str):
     """Creates directory at the given path if it does not already exist."""
-    if not os.path.exists(dir_path):
-        os.makedirs(dir_path)
+    os.makedirs(dir_path, exist_ok=True)
+
+
+def resolve_dir_path(dir_path: str) -> str:
+    """Returns an absolute version of the given directory path, joining
+    relative paths onto the working directory captured at module load."""
+    if os.path.isabs(dir_path):
+        return dir_path
+    return os.path.join(_CWD, dir_path)
+
+
+def escape_format(s: str) -> str:
+    """Escapes braces so the given string can be embedded in a format template."""
+    return s.replace("{", "{{").replace("}", "}}")
+
+
+def is_truthy(value) -> bool:
+    """Returns whether the given environment variable value is set to
+    a truthy value, like "1" or "true"."""
+    if isinstance(value, str):
+        return value.strip().lower() in ("1", "true", "yes", "on")
+    return bool(value)
 
 
 def deduce_dir_name(env_name: str):
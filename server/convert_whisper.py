@@ -0,0 +1,33 @@
+"""This module converts Whisper models to quantized CTranslate2 weights ahead of
+time, so that the server does not convert them on first use."""
+import argparse
+
+from config import Config
+from transcription.device import pick_device_and_compute_type
+from transcription.fwhspr import convert_model, get_converted_model_path
+
+
+def main():
+    """Converts the given Whisper models into the configured models directory"""
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("models", nargs="*", default=["base"],
+                        help="Whisper model sizes or Hugging Face model IDs")
+    parser.add_argument("--quantization",
+                        help="CTranslate2 compute type to quantize to; "
+                        "defaults to the one the server would use")
+    args = parser.parse_args()
+
+    config = Config()
+    if not config.whisper_models_dir_path:
+        parser.error("WHISPER_MODELS_DIR is not set")
+    config.ensure_dirs()
+    quantization = args.quantization or config.whisper_compute_type or \
+        pick_device_and_compute_type()[1]
+    for model_name in args.models:
+        convert_model(model_name, get_converted_model_path(
+            config.whisper_models_dir_path, model_name, quantization),
+            quantization)
+
+
+if __name__ == '__main__':
+    main()
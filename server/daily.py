@@ -1,14 +1,24 @@
 """This module handles all Daily REST API operations."""
 import dataclasses
 import datetime
-import json
+import functools
+import logging
 
+import orjson
 import requests
+from requests.adapters import HTTPAdapter
+
+log = logging.getLogger(__name__)
 
 DAILY_API_URL_DEFAULT = 'https://api.daily.co/v1'
 
+# Use a single session to persist HTTP connections to Daily's REST API
+# across calls, avoiding a new TCP and TLS handshake per request.
+session = requests.Session()
+session.mount('https://', HTTPAdapter(pool_connections=4, pool_maxsize=8))
+
 
-@dataclasses.dataclass
+@dataclasses.dataclass(slots=True, frozen=True)
 class Recording:
     """Class that represents a single Daily recording"""
     id: str
@@ -22,8 +32,8 @@ def fetch_recordings(api_key: str, api_url: str = DAILY_API_URL_DEFAULT,
     if not api_key:
         raise Exception("Daily API key not configured in server environment")
 
-    headers = {'Authorization': f'Bearer {api_key}'}
-    url = f'{api_url}/recordings'
+    headers = get_auth_headers(api_key)
+    url = get_recordings_url(api_url)
 
     params = {}
     if room_name is not None:
@@ -31,22 +41,18 @@ def fetch_recordings(api_key: str, api_url: str = DAILY_API_URL_DEFAULT,
     if limit > 0:
         params["limit"] = limit
 
-    print("Daily query url:", url, params)
-    res = requests.get(url, params=params, headers=headers, timeout=5)
+    log.debug("Daily query url: %s %s", url, params)
+    res = session.get(url, params=params, headers=headers, timeout=5)
     if not res.ok:
         raise Exception(
             f'Failed to fetch recordings; return code {res.status_code}; {res.text}')
-    data = json.loads(res.text)
-    recordings = data['data']
-    finished_recordings = []
-    for r in recordings:
-        start = r['start_ts']
-        duration = r['duration']
-        d = datetime.datetime.fromtimestamp(start)
-        timestamp = d + datetime.timedelta(0, duration)
-        recording = Recording(r['id'], r['room_name'], timestamp)
-        finished_recordings.append(recording)
-    return finished_recordings
+    data = orjson.loads(res.content)
+
+    # A recording's timestamp is the time at which it finished.
+    from_timestamp = datetime.datetime.fromtimestamp
+    return [Recording(r['id'], r['room_name'],
+                      from_timestamp(r['start_ts'] + r['duration']))
+            for r in data['data']]
 
 
 def get_access_link(api_key: str, recording_id: str,
@@ -55,13 +61,28 @@ def get_access_link(api_key: str, recording_id: str,
     if not api_key:
         raise Exception("Daily API key not configured in server environment")
 
-    url = f'{api_url}/recordings/{recording_id}/access-link'
-    headers = {'Authorization': f'Bearer {api_key}'}
+    url = f'{get_recordings_url(api_url)}/{recording_id}/access-link'
+    headers = get_auth_headers(api_key)
 
-    res = requests.get(url, headers=headers, timeout=5)
+    res = session.get(url, headers=headers, timeout=5)
     if not res.ok:
         raise Exception(
             f'Failed to get recording access link; return code {res.status_code}')
-    data = json.loads(res.text)
+    data = orjson.loads(res.content)
     download_link = data['download_link']
     return download_link
+
+
+@functools.lru_cache(maxsize=4)
+def get_auth_headers(api_key: str) -> dict:
+    """Returns Daily REST API authorization headers for the given API key.
+    The configured key does not change at runtime, so the headers are built
+    once and reused by every request."""
+    return {'Authorization': f'Bearer {api_key}'}
+
+
+@functools.lru_cache(maxsize=4)
+def get_recordings_url(api_url: str) -> str:
+    """Returns the recordings endpoint for the given Daily API URL,
+    falling back to the default API URL if none is configured."""
+    return f'{api_url or DAILY_API_URL_DEFAULT}/recordings'
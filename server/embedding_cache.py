@@ -0,0 +1,103 @@
+"""Module providing an on-disk cache of text chunk embeddings, so that
+unchanged chunks are not embedded again when an index is (re)built."""
+import hashlib
+import sqlite3
+import threading
+from array import array
+
+import torch
+from llama_index.bridge.pydantic import PrivateAttr
+from llama_index.embeddings import HuggingFaceEmbedding
+
+
+class EmbeddingCache:
+    """Class mapping hashes of chunk text to their embeddings, per model
+    and precision"""
+    _conn: sqlite3.Connection = None
+    _lock: threading.Lock = None
+
+    def __init__(self, file_path: str):
+        # Chunks are embedded from the index worker and from the thread
+        # creating the index, so the connection is shared under a lock.
+        self._conn = sqlite3.connect(file_path, check_same_thread=False)
+        self._lock = threading.Lock()
+        with self._lock, self._conn:
+            # The cache can always be rebuilt, so trade durability on power
+            # loss for fewer syncs.
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS embedding_cache("
+                "hash BLOB, model TEXT, vector BLOB, "
+                "PRIMARY KEY(hash, model))")
+
+    def get_many(self, hashes: list[bytes],
+                 model: str) -> dict[bytes, list[float]]:
+        """Returns cached embeddings of the given hashes, by hash"""
+        if not hashes:
+            return {}
+        placeholders = ",".join("?" * len(hashes))
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT hash, vector FROM embedding_cache "
+                f"WHERE model = ? AND hash IN ({placeholders})",
+                [model, *hashes]).fetchall()
+        return {h: array('f', v).tolist() for h, v in rows}
+
+    def put_many(self, items: list[tuple[bytes, list[float]]], model: str):
+        """Stores the given hashes and embeddings"""
+        with self._lock, self._conn:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embedding_cache VALUES (?, ?, ?)",
+                [(h, model, array('f', e).tobytes()) for h, e in items])
+
+
+def hash_text(text: str) -> bytes:
+    """Returns the cache key of the given chunk text"""
+    return hashlib.sha256(text.encode()).digest()
+
+
+class CachedHuggingFaceEmbedding(HuggingFaceEmbedding):
+    """HuggingFace embedding which only embeds chunks it has not embedded
+    before, looking up the rest in the given cache. Embeddings are cached
+    per model and precision, since the same model gives different
+    embeddings in different precisions."""
+    _cache: EmbeddingCache = PrivateAttr()
+    _cache_key: str = PrivateAttr()
+
+    def __init__(self, cache: EmbeddingCache, precision: str, **kwargs):
+        super().__init__(**kwargs)
+        self._cache = cache
+        self._cache_key = f"{self.model_name}/{precision}"
+
+    @classmethod
+    def class_name(cls) -> str:
+        return "CachedHuggingFaceEmbedding"
+
+    # Embeddings are computed in inference mode, so that no activations
+    # are kept around for a backward pass that never runs.
+    @torch.inference_mode()
+    def _get_query_embedding(self, query: str) -> list[float]:
+        return super()._get_query_embedding(query)
+
+    @torch.inference_mode()
+    def _get_text_embedding(self, text: str) -> list[float]:
+        return super()._get_text_embedding(text)
+
+    @torch.inference_mode()
+    def _get_text_embeddings(self, texts: list[str]) -> list[list[float]]:
+        hashes = [hash_text(t) for t in texts]
+        cached = self._cache.get_many(hashes, self._cache_key)
+
+        # Embed only the uncached chunks, in one batch, skipping duplicates.
+        missing = {}
+        for h, t in zip(hashes, texts):
+            if h not in cached:
+                missing.setdefault(h, t)
+        if missing:
+            embeddings = super()._get_text_embeddings(list(missing.values()))
+            new = list(zip(missing.keys(), embeddings))
+            self._cache.put_many(new, self._cache_key)
+            cached.update(new)
+
+        return [cached[h] for h in hashes]
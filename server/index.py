@@ -1,45 +1,131 @@
 """This module defines all the routes for the filler-word removal server."""
-import json
+import asyncio
+import atexit
+import dataclasses
+import logging
+import logging.handlers
 import os
-import sys
-import traceback
+import queue
+import secrets
+from typing import TYPE_CHECKING
 
+import orjson
 from quart_cors import cors
-from quart import Quart, request, jsonify, Response
+from quart import Quart, request, Response
+from quart.datastructures import FileStorage
 
 from config import Config
-from media import save_uploaded_file, get_uploaded_file_paths
-from store import Store, Source, State
+from media import (save_uploaded_file, get_uploaded_file_paths,
+                   remove_incomplete_uploads)
+
+if TYPE_CHECKING:
+    from store import Store
+
+# Log records are handed to a queue and written to stderr from a
+# background thread, so worker threads never block on output.
+log_queue = queue.SimpleQueue()
+log_listener = logging.handlers.QueueListener(
+    log_queue, logging.StreamHandler(), respect_handler_level=True)
+logging.basicConfig(
+    level=os.getenv("LOG_LEVEL", "WARNING").upper(),
+    handlers=[logging.handlers.QueueHandler(log_queue)])
+log_listener.start()
+atexit.register(log_listener.stop)
+log = logging.getLogger(__name__)
 
 app = Quart(__name__)
 
 # Allow uploads of up to 60MB by default.
 app.config['MAX_CONTENT_LENGTH'] = 1000000 * 60
+# Quart gives background work, such as an index being persisted, this
+# many seconds to finish when the server shuts down, and then cancels it.
+app.config['BACKGROUND_TASK_SHUTDOWN_TIMEOUT'] = 60
 
 # Note that this is not a secure CORS configuration for production.
 cors(app, allow_origin="*", allow_headers=["content-type"])
 config = Config()
 config.ensure_dirs()
+# No uploads can be in progress before the server starts.
+remove_incomplete_uploads(config.uploads_dir_path)
 
-store = Store(config=config, max_videos=10)
+# Server capabilities are fixed at startup, so serialize them only once.
+capabilities = orjson.dumps({
+    "daily": bool(config.daily_api_key)
+})
+
+# Cap how many uploads can be saved at once. Index creation and updates
+# are not counted, since only one can run at a time.
+upload_semaphore = asyncio.Semaphore(os.cpu_count() or 1)
+
+
+@dataclasses.dataclass
+class ServerState:
+    """Class holding the server's state which changes while it runs"""
+    # The store module pulls in the vector store, embedding, and
+    # transcription libraries, so it is imported and created in the
+    # background once the server has started instead of delaying startup.
+    store: "Store" = None
+    # The most recently serialized store status and the status version it
+    # was serialized from. The UI polls the status, which rarely changes.
+    status_cache: tuple[int, bytes] = (None, b'')
+    # Why the store could not be created, if it could not.
+    store_error: str = None
+
+
+server = ServerState()
+
+# Prefixes status ETags, since status versions start over whenever the
+# server restarts.
+status_etag_prefix = secrets.token_hex(8)
+
+
+def init_store():
+    """Creates the store and loads the index, in case one exists."""
+    try:
+        from store import Store  # pylint: disable=import-outside-toplevel
+        s = Store(config=config, max_videos=10)
+        s.load_index()
+    except Exception as e:
+        # Report the failure through the store status, rather than
+        # leaving the store loading forever.
+        msg = "Failed to create vector store"
+        log.exception(msg)
+        server.store_error = f"{msg}: {e}"
+        return
+    # Publish the store only once the index is loaded, so that no index
+    # creation or update can race the load.
+    server.store = s
+    if config.whisper_warmup:
+        # Pay the local model's load and first-run cost now rather than
+        # on the first transcription.
+        try:
+            s.transcriber.warmup()
+        except Exception:
+            log.exception("Failed to warm up the transcription model")
 
 
 @app.before_serving
 async def init():
     """Initialize the index before serving"""
     # Start loading the index right away, in case one exists.
-    app.add_background_task(store.load_index)
+    app.add_background_task(init_store)
 
 
 @app.after_serving
 async def shutdown():
-    """Stop all background tasks and threads"""
+    """Stop all remaining threads"""
+
+    # Quart has already waited for background tasks, up to the shutdown
+    # timeout, and cancelled any left over. Note that any running thread
+    # pool workers finish before shutdown is complete.
+    if server.store:
+        server.store.destroy()
+
 
-    # Note that any running thread pool workers finish
-    # before shutdown is complete.
-    store.destroy()
-    for task in app.background_tasks:
-        task.cancel()
+async def save_upload(file: FileStorage):
+    """Saves the given uploaded file once an upload slot is free."""
+    async with upload_semaphore:
+        await save_uploaded_file(file, config.uploads_dir_path)
 
 
 #############################
@@ -50,16 +136,36 @@ async def shutdown():
 def get_capabilities():
     """Returns server capabilities, such as whether a Daily API key
     has been configured or not."""
-    daily_supported = bool(config.daily_api_key)
-    return jsonify({
-        "daily": daily_supported
-    }), 200
+    return Response(capabilities, mimetype='application/json'), 200
 
 
 @app.route('/status/db', methods=['GET'])
 def get_store_status():
     """Returns store status"""
-    return jsonify(store.status), 200
+    store = server.store
+    if not store:
+        if server.store_error:
+            return orjsonify({
+                "state": "failed",
+                "message": server.store_error
+            }), 200
+        return orjsonify({
+            "state": "loading",
+            "message": "Loading vector store"
+        }), 200
+
+    # Only re-serialize the status if it has changed since the last request.
+    version, body = server.status_cache
+    if version != store.status_version:
+        version = store.status_version
+        body = orjson.dumps(store.status)
+        server.status_cache = (version, body)
+
+    etag = f'{status_etag_prefix}-{version}'
+    headers = {'ETag': f'W/"{etag}"', 'Cache-Control': 'max-age=1'}
+    if request.if_none_match.contains_weak(etag):
+        return Response(b'', headers=headers), 304
+    return Response(body, mimetype='application/json', headers=headers), 200
 
 
 @app.route('/status/uploads', methods=['GET'])
@@ -77,7 +183,7 @@ def get_uploaded_files():
         for path in uploads.in_progress:
             in_progress_file_names.append(os.path.basename(path))
 
-        return jsonify({
+        return orjsonify({
             "completed": completed_file_names,
             "in_progress": in_progress_file_names
         }), 200
@@ -91,33 +197,50 @@ def get_uploaded_files():
 @app.route('/db/index', methods=['POST'])
 async def init_or_update_store():
     """Initializes a new vector store or update the existing store"""
-    print("Initializing or updating vector store")
-
-    # Only proceed if a store-update operation is not already taking place
-    if store.status.state in [State.LOADING, State.CREATING, State.UPDATING]:
+    log.info("Initializing or updating vector store")
+    store = server.store
+    if not store:
         return process_error('Vector store not ready for further updates', 400)
+    from store import Source, State  # pylint: disable=import-outside-toplevel
+
     raw = await request.get_data()
-    data = json.loads(raw or 'null')
-    if data is None:
+    try:
+        data = orjson.loads(raw) if raw else None
+    except orjson.JSONDecodeError:
+        data = None
+    if not isinstance(data, dict):
         return process_error(
             "Must provide at least the 'source' property in request body", 400)
 
     # Check if user is updating index from Daily recordings or manual uploads
-    source = data["source"]
+    source = data.get("source")
     if source == "daily":
         index_source = Source.DAILY
-        room_name = data["room_name"]
-        if room_name:
-            store.daily_room_name = room_name
-        max_recordings = data["max_recordings"]
-        if max_recordings:
-            store.max_videos = int(max_recordings)
     elif source == "uploads":
         index_source = Source.UPLOADS
     else:
         return process_error(
             f"Unrecognized source: {source}. Source must be 'daily' or 'uploads'", 400)
 
+    # Only proceed if a store-update operation is not already taking place.
+    # The store is marked as creating or updating right away, with no
+    # await in between, so that further requests are rejected until this
+    # one's run has finished.
+    if store.status.state in [State.LOADING, State.CREATING, State.UPDATING]:
+        return process_error('Vector store not ready for further updates', 400)
+    if store.ready():
+        store.update_status(State.UPDATING, "Index update queued")
+    else:
+        store.update_status(State.CREATING, "Index creation queued")
+
+    if index_source == Source.DAILY:
+        room_name = data.get("room_name")
+        if room_name:
+            store.daily_room_name = room_name
+        max_recordings = data.get("max_recordings")
+        if max_recordings:
+            store.max_videos = int(max_recordings)
+
     # Start updating the store
     app.add_background_task(store.initialize_or_update, index_source)
     return '', 200
@@ -126,14 +249,15 @@ async def init_or_update_store():
 @app.route('/db/query', methods=['POST'])
 async def query_index():
     """Queries the loaded index"""
-    if not store.ready():
+    store = server.store
+    if not store or not store.ready():
         return process_error(
             "Vector index is not yet ready; try again later", 423)
     data = await request.get_json()
     query = data["query"]
     try:
         res = store.query(query)
-        return jsonify({
+        return orjsonify({
             "answer": res.response,
         }), 200
     except Exception as e:
@@ -154,21 +278,25 @@ async def upload_file():
     except Exception as e:
         return process_error(
             "failed to retrieve file from request. Was a file provided?", 400, e)
-    app.add_background_task(save_uploaded_file, file, config.uploads_dir_path)
+    app.add_background_task(save_upload, file)
     return "{}", 200
 
 
+def orjsonify(obj) -> Response:
+    """Returns a JSON response for the given object, serialized with orjson.
+    Dataclasses and enums, such as the store status, are serialized
+    natively."""
+    return Response(orjson.dumps(obj), mimetype='application/json')
+
+
 def process_error(msg: str, code=500, error: Exception = None,
                   ) -> tuple[Response, int]:
     """Prints provided error and returns appropriately-formatted response."""
     if error:
-        traceback.print_exc()
-        print(msg, error, file=sys.stderr)
+        log.error("%s: %s", msg, error, exc_info=error)
     response = {'error': msg}
-    return jsonify(response), code
-
+    return orjsonify(response), code
 
-app.run()
 
 if __name__ == '__main__':
     app.run(debug=True)
@@ -1,108 +1,350 @@
 """Module that handles media file operations, like saving uploads, stripping audio,
 returning existing uploads,etc."""
+import asyncio
 import dataclasses
+import hashlib
+import logging
 import os
-import pathlib
-import time
-from pathlib import Path
-from typing import List
+import shutil
+import subprocess
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
+import numpy as np
 import requests
-from moviepy.video.io.VideoFileClip import VideoFileClip
 from quart.datastructures import FileStorage
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+log = logging.getLogger(__name__)
+
+# Sample rate of the mono audio the transcribers work with.
+AUDIO_SAMPLE_RATE = 16000
+
+# Size of the chunks in which uploaded files are copied to disk.
+UPLOAD_CHUNK_SIZE = 1024 * 1024
+
+# Suffix of uploaded files which are still being written. An upload is
+# renamed to its final name only once it has been saved in full.
+IN_PROGRESS_SUFFIX = ".part"
+
+# Size of the buffer used to copy downloaded recordings to disk. Large
+# buffers mean one write per several megabytes of video.
+DOWNLOAD_CHUNK_SIZE = 4 * 1024 * 1024
+
+# Recordings larger than this are downloaded as byte ranges of this size,
+# several at a time, if the server supports range requests.
+DOWNLOAD_RANGE_SIZE = 64 * 1024 * 1024
+DOWNLOAD_WORKERS = 4
+# Connect and read timeouts of download requests, in seconds. The read
+# timeout applies to each wait for more data, not to the whole download.
+DOWNLOAD_TIMEOUT = (10, 300)
+
+# Use a single session to persist HTTP connections across downloads,
+# avoiding superfluous round-trips. The pool is sized for several
+# recordings downloading their byte ranges at once, and transient
+# failures are retried with backoff.
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=16,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=5,
+        backoff_factor=0.5,
+        status_forcelist=[502, 503, 504],
+        respect_retry_after_header=True)))
 
 
 @dataclasses.dataclass
 class Uploads:
-    """Class representing manual uploads completed or in progress"""
+    """Class representing manual uploads completed or in progress, and
+    audio already extracted from uploads"""
     complete: list[str]
     in_progress: list[str]
+    audio: list[str] = dataclasses.field(default_factory=list)
 
 
 async def save_uploaded_file(file: FileStorage, uploads_dir: str):
     """Saves given file to the configured upload directory"""
     file_name = os.path.basename(file.filename)
 
-    video_path = os.path.join(uploads_dir, file_name)
-    file_path = Path(video_path)
+    file_path = os.path.join(uploads_dir, file_name)
+    in_progress_path = f"{file_path}{IN_PROGRESS_SUFFIX}"
     try:
-        await file.save(file_path)
-        if not os.path.exists(file_path):
-            raise Exception("Uploaded file not saved", file_path)
+        # Quart spools large multipart files to a temporary file; copy it
+        # to its destination within the kernel where possible, otherwise in
+        # large chunks rather than the 16KB default.
+        copied = await asyncio.to_thread(
+            copy_spooled_upload, file, in_progress_path)
+        if not copied:
+            await file.save(in_progress_path, buffer_size=UPLOAD_CHUNK_SIZE)
+        # Renaming is atomic, so a file with its final name is always
+        # complete.
+        os.replace(in_progress_path, file_path)
     except Exception as e:
+        if os.path.exists(in_progress_path):
+            os.remove(in_progress_path)
         raise Exception("Failed to save uploaded file") from e
 
 
+def copy_spooled_upload(file: FileStorage, destination: str) -> bool:
+    """Copies the given upload to the destination without passing its
+    contents through Python, if the upload has been spooled to disk and
+    the platform supports it. Returns whether the upload was copied."""
+    if not hasattr(os, 'copy_file_range'):
+        return False
+    stream = file.stream
+    # Asking an in-memory spooled file for its descriptor would write it
+    # out to disk first.
+    # pylint: disable-next=protected-access
+    if isinstance(stream, tempfile.SpooledTemporaryFile) and not stream._rolled:
+        return False
+    try:
+        src_fd = stream.fileno()
+    except (AttributeError, OSError, ValueError):
+        return False
+
+    size = os.fstat(src_fd).st_size
+    try:
+        with open(destination, 'wb') as dst:
+            offset = 0
+            while offset < size:
+                copied = os.copy_file_range(
+                    src_fd, dst.fileno(), size - offset, offset, offset)
+                if copied == 0:
+                    break
+                offset += copied
+    except OSError:
+        # E.g. a cross-filesystem copy on an older kernel.
+        return False
+    return offset == size
+
+
 def get_uploaded_file_paths(uploads_dir_path: str) -> Uploads:
     """Returns paths of all mp4 files in the uploads directory,
     indicating whether the upload is completed or in progress."""
+    # Uploads still being saved carry the in-progress suffix, so a single
+    # directory scan tells complete and in-progress files apart. The
+    # directory entry's cached type avoids a stat call per entry.
     completed = []
     in_progress = []
-    for path in pathlib.Path(uploads_dir_path).iterdir():
-        if not path.is_file() or path.suffix != ".mp4":
-            continue
-
-        old_file_size = os.path.getsize(path)
-        time.sleep(2)
-        new_file_size = os.path.getsize(path)
-        if old_file_size == new_file_size:
-            completed.append(str(path))
-        else:
-            in_progress.append(str(path))
+    audio = []
+    with os.scandir(uploads_dir_path) as entries:
+        for entry in entries:
+            if not entry.is_file(follow_symlinks=False):
+                continue
+            name = entry.name
+            if name.endswith(".mp4"):
+                completed.append(entry.path)
+            elif name.endswith(f".mp4{IN_PROGRESS_SUFFIX}"):
+                in_progress.append(entry.path[:-len(IN_PROGRESS_SUFFIX)])
+            elif name.endswith(".wav"):
+                audio.append(entry.path)
 
-    return Uploads(completed, in_progress)
+    return Uploads(completed, in_progress, audio)
 
 
-def produce_local_audio_from_url(
-        recording_url: str, video_file_name: str, recordings_dir_path: str):
-    """Downloads a recording from the given URL and extracts audio from it"""
-    video_path = download_recording(
-        recording_url,
-        video_file_name,
-        recordings_dir_path)
-    print("Downloaded recording:", video_path)
-    audio_path = extract_audio(video_path)
-    print("Extracted audio:", audio_path)
-    os.remove(video_path)
-    return audio_path
+def remove_incomplete_uploads(uploads_dir_path: str):
+    """Removes uploads left in progress by a previous server run, which
+    would otherwise be reported as in progress forever."""
+    with os.scandir(uploads_dir_path) as entries:
+        for entry in entries:
+            if entry.name.endswith(IN_PROGRESS_SUFFIX) and \
+                    entry.is_file(follow_symlinks=False):
+                os.remove(entry.path)
+
+
+def decode_audio_from_url(
+        recording_url: str, video_file_name: str,
+        recordings_dir_path: str) -> np.ndarray:
+    """Decodes audio from the recording at the given URL"""
+    try:
+        # ffmpeg reads the recording straight from its URL, seeking with
+        # range requests where needed, so the video is never written to disk.
+        audio = decode_audio(recording_url)
+    except Exception as e:
+        # Fall back to downloading the recording first, e.g. if this
+        # ffmpeg build cannot read HTTPS sources.
+        log.warning(
+            "Failed to stream recording audio; downloading recording: %s", e)
+        video_path = download_recording(
+            recording_url,
+            video_file_name,
+            recordings_dir_path)
+        log.debug("Downloaded recording: %s", video_path)
+        try:
+            audio = decode_audio(video_path)
+        finally:
+            os.remove(video_path)
+    log.debug("Decoded audio: %s", recording_url)
+    return audio
 
 
 def download_recording(
         recording_url: str, video_file_name: str, recordings_dir_path: str):
-    """Downloads Daily recording"""
+    """Downloads Daily recording, fetching byte ranges in parallel
+    if the server supports it"""
     local_file_path = os.path.join(
         recordings_dir_path,
         f'{video_file_name}.mp4')
 
     try:
+        # Request only the first range. A 206 response tells us the server
+        # supports range requests and how large the recording is; a 200
+        # response contains the whole recording.
+        res = session.get(
+            recording_url,
+            headers={'Range': f'bytes=0-{DOWNLOAD_RANGE_SIZE - 1}'},
+            stream=True, timeout=DOWNLOAD_TIMEOUT)
+        res.raise_for_status()
+        ranged = res.status_code == 206
+        if ranged:
+            total = res.headers.get('Content-Range', '').rpartition('/')[2]
+        else:
+            total = res.headers.get('Content-Length', '')
+        size = int(total) if total.isdigit() else None
+
         with open(local_file_path, 'wb') as f:
-            # Use a single session to persist HTTP connections, avoiding
-            # superfluous round-trips.
-            session = requests.Session()
-            res = session.get(recording_url, stream=True)
-            res.raise_for_status()
-            for chunk in res.iter_content(1024 * 250):
-                f.write(chunk)
-            return local_file_path
+            if size:
+                preallocate(f, size)
+            # Let the copy loop run over the raw response stream rather than
+            # re-entering Python for every small chunk.
+            res.raw.decode_content = True
+            shutil.copyfileobj(res.raw, f, DOWNLOAD_CHUNK_SIZE)
+            received = f.tell()
+            if not ranged:
+                # Trim any space reserved beyond what was actually written.
+                f.truncate(received)
+
+        if ranged:
+            if size:
+                download_ranges(recording_url, local_file_path,
+                                DOWNLOAD_RANGE_SIZE, size)
+            elif received >= DOWNLOAD_RANGE_SIZE:
+                # Size unknown; fetch the rest in one go. A shorter first
+                # range means there is nothing left to fetch.
+                download_range(recording_url, local_file_path,
+                               DOWNLOAD_RANGE_SIZE)
+        return local_file_path
     except Exception as e:
         raise Exception('failed to download Daily recording') from e
 
 
-def extract_audio(video_path: str):
-    """Extracts audio from given MP4 file"""
-    audio_path = get_audio_path(video_path)
+def download_ranges(url: str, file_path: str, start: int, size: int):
+    """Downloads the given URL from the start offset onwards into the
+    same offsets of the given, already pre-sized, file, several byte
+    ranges at a time."""
+    if start >= size:
+        return
+
+    ranges = [(lo, min(lo + DOWNLOAD_RANGE_SIZE, size) - 1)
+              for lo in range(start, size, DOWNLOAD_RANGE_SIZE)]
+    with ThreadPoolExecutor(max_workers=DOWNLOAD_WORKERS) as executor:
+        futures = [executor.submit(download_range, url, file_path, lo, hi)
+                   for lo, hi in ranges]
+        for future in futures:
+            future.result()
+
+
+def download_range(url: str, file_path: str, start: int, end: int = None):
+    """Downloads the given byte range of the URL into the same offset of
+    the given file. If no end is given, downloads to the end of the URL."""
+    open_ended = end is None
+    end = '' if open_ended else end
+    res = session.get(url, headers={'Range': f'bytes={start}-{end}'},
+                      stream=True, timeout=DOWNLOAD_TIMEOUT)
+    if open_ended and res.status_code == 416:
+        # The start is past the end of the URL, so everything has
+        # already been downloaded.
+        return
+    res.raise_for_status()
+    if res.status_code != 206:
+        raise Exception("Server did not return requested byte range",
+                        start, end, res.status_code)
+    with open(file_path, 'r+b') as f:
+        f.seek(start)
+        res.raw.decode_content = True
+        shutil.copyfileobj(res.raw, f, DOWNLOAD_CHUNK_SIZE)
+
+
+def preallocate(f, size: int):
+    """Reserves the given number of bytes of disk space for the given file
+    up front, so that it is allocated in one go rather than extended with
+    every write."""
     try:
-        video = VideoFileClip(video_path)
-        video.audio.write_audiofile(audio_path)
+        os.posix_fallocate(f.fileno(), 0, size)
+    except (AttributeError, OSError):
+        # posix_fallocate is not available on every platform or filesystem.
+        f.truncate(size)
+
+
+def extract_audio(video_path: str, audio_path: str = None):
+    """Extracts audio from given MP4 file or URL, to the given audio path
+    if one is provided."""
+    if not audio_path:
+        audio_path = get_audio_path(video_path)
+    try:
+        run_ffmpeg(video_path, ['-acodec', 'pcm_s16le', audio_path])
+    except subprocess.CalledProcessError as e:
+        raise Exception('failed to save extracted audio file',
+                        video_path, audio_path,
+                        e.stderr.decode(errors='replace')) from e
     except Exception as e:
         raise Exception('failed to save extracted audio file',
                         video_path, audio_path) from e
     return audio_path
 
 
+def decode_audio(source: str) -> np.ndarray:
+    """Decodes audio from given MP4 file or URL into memory, as int16
+    samples, without writing an intermediate audio file. Decoded audio
+    waits in memory until it is transcribed, so it is kept at half the
+    size of float32 samples until then."""
+    try:
+        res = run_ffmpeg(source, ['-f', 's16le', '-acodec', 'pcm_s16le', '-'])
+    except subprocess.CalledProcessError as e:
+        raise Exception('failed to decode audio', source,
+                        e.stderr.decode(errors='replace')) from e
+    except Exception as e:
+        raise Exception('failed to decode audio', source) from e
+    return np.frombuffer(res.stdout, dtype=np.int16)
+
+
+def run_ffmpeg(source: str, output_args: list[str]):
+    """Runs ffmpeg to decode the audio of the given source to 16kHz mono,
+    which is what the transcribers work with, with the given output
+    arguments."""
+    # Have ffmpeg drop the video stream and decode the audio only.
+    # -nostdin stops ffmpeg from waiting on the server's terminal.
+    return subprocess.run(
+        ['ffmpeg', '-nostdin', '-loglevel', 'error', '-y', '-threads', '0',
+         '-i', source, '-vn', '-ar', str(AUDIO_SAMPLE_RATE), '-ac', '1',
+         *output_args],
+        check=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+
+
+def hash_file(file_path: str) -> str:
+    """Returns a hex digest of the given file's contents"""
+    with open(file_path, 'rb') as f:
+        return hashlib.file_digest(f, 'blake2b').hexdigest()
+
+
+def to_float_audio(audio: np.ndarray) -> np.ndarray:
+    """Converts the given int16 samples to float32 samples between -1 and
+    1, as the transcribers take them"""
+    audio = audio.astype(np.float32)
+    audio *= 1 / 32768
+    return audio
+
+
+def hash_audio(audio: np.ndarray) -> str:
+    """Returns a hex digest of the given decoded audio"""
+    return hashlib.blake2b(audio).hexdigest()
+
+
 def get_audio_path(video_path: str) -> str:
     """Returns audio path for a given file name"""
     audio_dir = os.path.dirname(video_path)
-    file_name = pathlib.Path(video_path).stem
+    file_name = os.path.splitext(os.path.basename(video_path))[0]
     audio_path = os.path.join(audio_dir, f'{file_name}.wav')
     return audio_path
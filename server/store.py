@@ -1,32 +1,44 @@
 """This module generates transcripts from the configured Daily domain's recordings
 and uses them to create a query-able vector store."""
 import asyncio
+import contextlib
 import dataclasses
+import functools
+import logging
 import os.path
-import pathlib
-import sys
-import traceback
+import sqlite3
+import threading
+import time
 from concurrent.futures import ThreadPoolExecutor
 
 from enum import Enum
 
 import chromadb
+import numpy as np
+import orjson
+import torch
 from llama_index import VectorStoreIndex, SimpleDirectoryReader, StorageContext, \
-    Response, load_index_from_storage, Document
+    Response, load_index_from_storage, Document, ServiceContext
 from llama_index.embeddings import HuggingFaceEmbedding
 from llama_index.indices.base import BaseIndex
+from llama_index.query_engine import RetrieverQueryEngine
 from llama_index.storage.docstore import SimpleDocumentStore
 from llama_index.storage.index_store import SimpleIndexStore
+from llama_index.utils import infer_torch_device
 from llama_index.vector_stores import ChromaVectorStore
+from transformers import AutoModel, AutoTokenizer
 
 from config import Config
+from embedding_cache import CachedHuggingFaceEmbedding, EmbeddingCache
 from daily import fetch_recordings, get_access_link, Recording
-from media import (produce_local_audio_from_url, get_audio_path,
-                   extract_audio, get_uploaded_file_paths
-                   )
-from transcription.dg import DeepgramTranscriber
-from transcription.whspr import WhisperTranscriber
+from media import (decode_audio_from_url, decode_audio, get_audio_path,
+                   extract_audio, get_uploaded_file_paths, hash_audio,
+                   hash_file, to_float_audio)
 from transcription.transcriber import Transcriber
+from vector_cache import VectorCache, VectorCacheRetriever
+
+
+log = logging.getLogger(__name__)
 
 
 class State(str, Enum):
@@ -52,11 +64,144 @@ class Status:
     message: str
 
 
+@dataclasses.dataclass
+class PendingTranscript:
+    """Class representing a video moving through the transcription pipeline"""
+    transcript_file_path: str
+    recording_url: str = None
+    audio_path: str = None
+    # Decoded int16 samples, for transcribers which require local audio.
+    audio: np.ndarray = None
+    audio_hash: str = None
+    transcript: str = None
+
+
+# Marks the end of a pipeline stage's input.
+PIPELINE_DONE = object()
+# Tells the index stage that its pending transcripts are due to be flushed.
+FLUSH_DUE = object()
+
+
+EMBED_MODEL_NAME = "BAAI/bge-base-en-v1.5"
+
+
+@functools.lru_cache(maxsize=1)
+def get_embed_model(cache_file_path: str,
+                    compile_model: bool = False) -> HuggingFaceEmbedding:
+    """Returns the embed model, loading it on first use only. Chunks are
+    embedded in large batches, on the GPU if one is available. GPU weights
+    are loaded in half precision, and CPU weights are quantized to int8.
+    Embeddings are cached in the given file, so unchanged chunks are not
+    embedded again when an index is created. GPU models can optionally be
+    compiled with torch.compile."""
+    device = infer_torch_device()
+    # The model is only ever used for inference, so do not track gradients.
+    model = AutoModel.from_pretrained(EMBED_MODEL_NAME).eval()
+    model.requires_grad_(False)
+    if device == "cpu":
+        model = torch.quantization.quantize_dynamic(
+            model, {torch.nn.Linear}, dtype=torch.qint8)
+        precision = "int8"
+    else:
+        model = model.half()
+        precision = "float16"
+    model = model.to(device)
+    if compile_model and device == "cuda":
+        # Batches vary in sequence length, so compile for dynamic shapes
+        # rather than recompiling for every new length.
+        model = torch.compile(model, dynamic=True)
+    return CachedHuggingFaceEmbedding(
+        EmbeddingCache(cache_file_path),
+        precision,
+        model_name=EMBED_MODEL_NAME,
+        model=model,
+        tokenizer=AutoTokenizer.from_pretrained(EMBED_MODEL_NAME),
+        device=device,
+        embed_batch_size=128)
+
+
+@functools.lru_cache(maxsize=4)
+def get_chroma_client(path: str) -> chromadb.PersistentClient:
+    """Returns the persistent Chroma client for the given path, opening it
+    on first use only."""
+    # Switch Chroma's database to write-ahead logging, so that queries
+    # are not blocked while transcripts are being inserted. The journal
+    # mode is stored in the database file, so this is only needed once.
+    with contextlib.closing(
+            sqlite3.connect(os.path.join(path, "chroma.sqlite3"))) as conn:
+        conn.execute("PRAGMA journal_mode=WAL")
+    return chromadb.PersistentClient(path=path)
+
+
+def get_recording_file_name(recording: Recording) -> str:
+    """Returns the file name, without extension, of the transcript
+    and audio of the given Daily recording"""
+    return f"{recording.timestamp}_{recording.room_name}_{recording.id}"
+
+
+def create_transcriber(config: Config, local_workers: int) -> Transcriber:
+    """Returns the transcriber selected by the given config. Deepgram is
+    used if its API key is specified, and a local Whisper model otherwise.
+    Whisper runs on faster-whisper unless another backend is requested.
+    Each backend is only imported when selected, so that only the selected
+    backend's dependencies need to be installed."""
+    if config.deepgram_api_key:
+        from transcription.dg import DeepgramTranscriber  # pylint: disable=import-outside-toplevel
+        return DeepgramTranscriber(
+            config.deepgram_api_key, config.deepgram_model_name)
+    backend = config.whisper_backend
+    if backend == "openai-whisper":
+        from transcription.whspr import WhisperTranscriber  # pylint: disable=import-outside-toplevel
+        return WhisperTranscriber(
+            config.whisper_device, config.whisper_compile,
+            config.whisper_model_name, config.whisper_trim_silence)
+    if backend == "whisper.cpp":
+        from transcription.cppwhspr import WhisperCppTranscriber  # pylint: disable=import-outside-toplevel
+        return WhisperCppTranscriber(
+            config.whisper_model_name, config.whisper_models_dir_path)
+    if backend and backend != "faster-whisper":
+        raise Exception(f"Unknown Whisper backend: {backend}")
+    from transcription.fwhspr import FasterWhisperTranscriber  # pylint: disable=import-outside-toplevel
+    return FasterWhisperTranscriber(
+        model_name=config.whisper_model_name,
+        num_workers=local_workers,
+        device=config.whisper_device,
+        compute_type=config.whisper_compute_type,
+        models_dir=config.whisper_models_dir_path)
+
+
+def load_audio_hashes(
+        file_path: str) -> tuple[dict[str, str], dict[str, str]]:
+    """Loads previously-persisted audio hashes and duplicate transcripts,
+    if any exist"""
+    try:
+        with open(file_path, 'rb') as f:
+            data = orjson.loads(f.read())
+    except FileNotFoundError:
+        return {}, {}
+    except orjson.JSONDecodeError as e:
+        # The hashes only prevent duplicate work, so start over rather than
+        # failing to create the store.
+        log.warning("Ignoring unreadable audio hashes file %s: %s",
+                    file_path, e)
+        return {}, {}
+    # Older files hold only the audio hashes.
+    if "hashes" not in data:
+        return data, {}
+    return data["hashes"], data["duplicates"]
+
+
 class Store:
     """Class that manages all vector store indexing operations and status updates."""
     status = Status(State.UNINITIALIZED.value, "The store is uninitialized")
+    # Incremented on every status update, so that callers can tell
+    # whether the status has changed since they last read it.
+    status_version: int = 0
     config: Config = None
     index: BaseIndex = None
+    # In-memory copy of the indexed chunks, used to answer queries
+    # without a round-trip through Chroma.
+    vector_cache: VectorCache = None
     transcriber: Transcriber = None
     collection_name = "my_first_collection"
 
@@ -64,6 +209,48 @@ class Store:
     daily_room_name: str = None
     max_videos: int = None
 
+    # Number of workers for each stage of the transcription pipeline.
+    # Audio preparation is mostly network and ffmpeg bound, with one ffmpeg
+    # process per worker, local transcription is compute bound, and index
+    # insertion is serialized. Remote transcription workers spend their
+    # time waiting on the transcription API, so many can run at once.
+    prepare_workers = max(4, min(os.cpu_count() or 1, 8))
+    local_transcribe_workers = 2
+    remote_transcribe_workers = 32
+
+    # Number of transcripts to accumulate before inserting them into the
+    # index together, so that their chunks are embedded and written to
+    # Chroma in batches. Pending transcripts are also inserted once the
+    # oldest has waited for the flush interval, in seconds, so that they
+    # become queryable while slow transcriptions are still running.
+    index_batch_size = 64
+    index_flush_interval = 10
+    pending_documents: list[Document] = None
+    pending_since: float = None
+    # Whether documents have been inserted since the index was last
+    # persisted.
+    index_changed: bool = False
+    # Transcripts saved by the current run while there is no index yet.
+    # They are kept in memory as pending documents, so that the index is
+    # created from them without reading them back from disk.
+    new_transcript_paths: set[str] = None
+    # Paths of audio already extracted from uploads when the current
+    # pipeline run started.
+    existing_upload_audio: set[str] = None
+
+    # Maps hashes of transcribed audio to the transcript produced from it,
+    # so that the same audio uploaded under another name is not
+    # transcribed and indexed again.
+    audio_hashes: dict[str, str] = None
+    # Maps transcript paths of videos whose audio duplicates an already
+    # transcribed video to the transcript path of the original, so that
+    # duplicate Daily recordings are not fetched again on every run.
+    duplicate_transcripts: dict[str, str] = None
+    # Hashes of audio being transcribed by the current run. They are only
+    # added to the audio hashes once the transcript has been saved.
+    claimed_audio_hashes: dict[str, str] = None
+    audio_hashes_lock: threading.Lock = None
+
     executors = []
 
     def __init__(
@@ -73,22 +260,31 @@ class Store:
             max_videos: int = None,
             transcriber: Transcriber = None):
         self.config = config
+        self.vector_cache = VectorCache()
+        self.pending_documents = []
+        self.new_transcript_paths = set()
+        self.audio_hashes, self.duplicate_transcripts = load_audio_hashes(
+            config.audio_hashes_file_path)
+        self.claimed_audio_hashes = {}
+        self.audio_hashes_lock = threading.Lock()
         self.daily_room_name = daily_room_name
         self.max_videos = max_videos
         if not transcriber:
-            # Default to local Whisper model if Deepgram API key is not
-            # specified
-            transcriber = WhisperTranscriber()
-            if config.deepgram_api_key:
-                transcriber = DeepgramTranscriber(
-                    config.deepgram_api_key, config.deepgram_model_name)
+            transcriber = create_transcriber(
+                config, self.local_transcribe_workers)
         self.transcriber = transcriber
 
     def query(self, query: str) -> Response:
         """Queries the existing index, if one exists."""
         if not self.ready():
             raise Exception("Index not yet initialized. Try again later")
-        engine = self.index.as_query_engine()
+        if self.vector_cache.ready():
+            retriever = VectorCacheRetriever(
+                self.vector_cache, self.index.service_context.embed_model)
+            engine = RetrieverQueryEngine.from_args(
+                retriever, service_context=self.index.service_context)
+        else:
+            engine = self.index.as_query_engine()
         response = engine.query(query)
         return response
 
@@ -105,16 +301,19 @@ class Store:
                 index_store=SimpleIndexStore.from_persist_dir(
                     persist_dir=save_dir),
             )
-            index = load_index_from_storage(storage_context)
+            index = load_index_from_storage(
+                storage_context, service_context=self.get_service_context())
             if index is not None:
+                self.vector_cache.add_from_collection(vector_store.client)
                 self.index = index
                 self.update_status(
                     State.READY, "Index loaded and ready to query")
                 return True
         except FileNotFoundError:
-            print("Existing index not found. Store will not be loaded.")
+            log.info("Existing index not found. Store will not be loaded.")
         except ValueError as e:
-            print("Failed to load index; collection likely not found", e)
+            log.warning(
+                "Failed to load index; collection likely not found: %s", e)
         self.update_status(State.UNINITIALIZED)
         return False
 
@@ -128,6 +327,10 @@ class Store:
         else:
             self.update_status(State.UPDATING, "Updating index")
 
+        # Drop anything left pending by a previous, failed run.
+        self.pending_documents = []
+        self.new_transcript_paths = set()
+
         try:
             # Transcribe videos from given source.
             if source == Source.DAILY:
@@ -138,12 +341,14 @@ class Store:
             # If index creation is required, do so.
             if create_index:
                 self.create_index()
-            self.index.storage_context.persist(self.config.index_dir_path)
+            # Persist once per run, and only if the run changed the index.
+            if create_index or self.index_changed:
+                self.index.storage_context.persist(self.config.index_dir_path)
+                self.index_changed = False
             self.update_status(State.READY, "Index ready to query")
-        except Exception as e:
+        except Exception:
             msg = "Failed to create or update index"
-            print(f"{msg}: {e}", file=sys.stderr)
-            traceback.print_exc()
+            log.exception(msg)
             self.update_status(State.ERROR,  msg)
 
     async def process_uploads(self):
@@ -152,39 +357,51 @@ class Store:
         uploads = get_uploaded_file_paths(
             self.config.uploads_dir_path)
 
-        uploaded_file_paths = uploads.complete
-        tasks = []
-        loop = asyncio.get_event_loop()
-        # Process five files at a time
-        executor = ThreadPoolExecutor(max_workers=5)
-        self.executors.append(executor)
-        for path in uploaded_file_paths:
-            if not path.endswith(".mp4") and not path.endswith(".mov"):
+        # Only completed MP4 uploads are returned, so the only check needed
+        # is whether a video has already been transcribed. Do so before
+        # starting the pipeline, so that such videos never occupy a worker.
+        existing = self.list_transcripts()
+        self.existing_upload_audio = set(uploads.audio)
+        pending = []
+        for video_path in uploads.complete:
+            file_name = os.path.splitext(os.path.basename(video_path))[0]
+            if f"{file_name}.txt" in existing:
+                os.remove(video_path)
                 continue
-            task = loop.run_in_executor(
-                executor, self.transcribe_and_index_file, path)
-            tasks.append(task)
-
-        # Wait for all processing tasks to finish
-        await asyncio.gather(*tasks)
-        self.executors.remove(executor)
+            pending.append(video_path)
+        await self.run_pipeline(pending, self.prepare_upload)
 
     def create_index(self):
         """Creates a new index
          See: https://gpt-index.readthedocs.io/en/latest/examples/vector_stores/ChromaIndexDemo.html
         """
 
-        # Get all documents from the present transcripts
-        documents = SimpleDirectoryReader(
-            self.config.transcripts_dir_path
-        ).load_data()
+        # This run's transcripts are already in memory; read only those
+        # saved by previous runs from disk.
+        documents = self.pending_documents
+        new_paths = self.new_transcript_paths
+        self.pending_documents = []
+        self.new_transcript_paths = set()
+        with os.scandir(self.config.transcripts_dir_path) as entries:
+            old_paths = [e.path for e in entries
+                         if e.is_file() and not e.name.startswith(".")
+                         and e.path not in new_paths]
+        if old_paths:
+            documents += SimpleDirectoryReader(
+                input_files=old_paths
+            ).load_data()
 
         vector_store = self.get_vector_store()
         storage_context = StorageContext.from_defaults(
             vector_store=vector_store)
         index = VectorStoreIndex.from_documents(
-            documents, storage_context=storage_context
+            documents,
+            storage_context=storage_context,
+            service_context=self.get_service_context(),
+            show_progress=True
         )
+        self.vector_cache.clear()
+        self.vector_cache.add_from_collection(vector_store.client)
         self.index = index
 
     async def process_daily_recordings(self):
@@ -199,130 +416,330 @@ class Store:
             self.daily_room_name,
             self.max_videos)
 
-        tasks = []
-        loop = asyncio.get_event_loop()
-        executor = ThreadPoolExecutor(max_workers=5)
-        self.executors.append(executor)
+        # Skip recordings which have already been transcribed, or whose
+        # audio duplicates a transcribed recording, before starting the
+        # pipeline, so that they never occupy a worker.
+        existing = self.list_transcripts()
+        pending = []
         for recording in recordings:
-            task = loop.run_in_executor(
-                executor, self.transcribe_and_index_recording, recording)
-            tasks.append(task)
-
-        # Wait for tasks to complete
-        await asyncio.gather(*tasks)
-
-        self.executors.remove(executor)
-
-    def transcribe_and_index_file(self, video_path):
-        """Transcribes and indexes locally-saved video recording."""
-        file_name = pathlib.Path(video_path).stem
+            file_name = get_recording_file_name(recording)
+            if f"{file_name}.txt" in existing:
+                continue
+            original = self.duplicate_transcripts.get(
+                self.config.get_transcript_file_path(file_name))
+            if original and os.path.basename(original) in existing:
+                continue
+            pending.append(recording)
+        await self.run_pipeline(pending, self.prepare_recording)
+
+    def list_transcripts(self) -> set[str]:
+        """Returns the file names of all existing transcripts"""
+        with os.scandir(self.config.transcripts_dir_path) as entries:
+            return {e.name for e in entries}
+
+    async def run_pipeline(self, items: list, prepare):
+        """Runs the given items through a pipeline of audio preparation,
+        transcription, and indexing stages. Each stage has its own workers
+        and bounded input queue, so that while one video is transcribing
+        the next ones are already having their audio prepared."""
+        transcribe_workers = self.local_transcribe_workers
+        if not self.transcriber.requires_local_audio():
+            transcribe_workers = self.remote_transcribe_workers
+        max_concurrency = self.transcriber.max_concurrency()
+        if max_concurrency:
+            transcribe_workers = min(transcribe_workers, max_concurrency)
+        prepare_workers = self.prepare_workers
+        if self.transcriber.requires_local_audio():
+            # Each prepare worker can hold a whole recording's decoded audio
+            # while it waits for room in the transcription queue, so have
+            # no more of them than the queue has room for.
+            prepare_workers = min(prepare_workers, transcribe_workers * 2)
+        stages = [
+            (prepare, prepare_workers),
+            (self.transcribe_pending, transcribe_workers),
+            (self.index_pending, 1),
+        ]
+
+        loop = asyncio.get_running_loop()
+        queues = [asyncio.Queue(maxsize=workers * 2)
+                  for _, workers in stages]
+        executors = [ThreadPoolExecutor(max_workers=workers)
+                     for _, workers in stages]
+        self.executors.extend(executors)
+        # Drop claims left by a previous, aborted run.
+        with self.audio_hashes_lock:
+            self.claimed_audio_hashes = {}
+
+        async def feed():
+            for item in items:
+                await queues[0].put(item)
+            for _ in range(stages[0][1]):
+                await queues[0].put(PIPELINE_DONE)
+
+        async def work(i: int):
+            func = stages[i][0]
+            while (item := await get_next(i)) is not PIPELINE_DONE:
+                if item is FLUSH_DUE:
+                    await loop.run_in_executor(
+                        executors[i], self.flush_documents)
+                    continue
+                result = await loop.run_in_executor(executors[i], func, item)
+                if result is not None and i + 1 < len(stages):
+                    await queues[i + 1].put(result)
+
+        async def get_next(i: int):
+            # The index stage stops waiting for input once its oldest
+            # pending transcript is due to be flushed, so that finished
+            # transcripts become queryable even if no more arrive for a
+            # while.
+            timeout = None
+            if i == len(stages) - 1:
+                timeout = self.flush_due_in()
+            try:
+                return await asyncio.wait_for(queues[i].get(), timeout)
+            except TimeoutError:
+                return FLUSH_DUE
+
+        async def run_stage(i: int):
+            async with asyncio.TaskGroup() as workers:
+                for _ in range(stages[i][1]):
+                    workers.create_task(work(i))
+            # Let the next stage's workers know there is no more input.
+            if i + 1 < len(stages):
+                for _ in range(stages[i + 1][1]):
+                    await queues[i + 1].put(PIPELINE_DONE)
 
+        try:
+            # If any stage fails, the remaining stages are cancelled.
+            async with asyncio.TaskGroup() as tg:
+                tg.create_task(feed())
+                for i in range(len(stages)):
+                    tg.create_task(run_stage(i))
+            # Index whatever did not fill a complete batch.
+            await loop.run_in_executor(executors[-1], self.flush_documents)
+        finally:
+            self.save_audio_hashes()
+            for executor in executors:
+                self.executors.remove(executor)
+                executor.shutdown(wait=False)
+
+    def prepare_upload(self, video_path: str) -> PendingTranscript:
+        """Extracts audio from a locally-saved video recording, unless the
+        same audio has already been transcribed."""
+        file_name = os.path.splitext(os.path.basename(video_path))[0]
         transcript_file_path = self.config.get_transcript_file_path(file_name)
-        # Don't re-transcribe if a transcript for this recording already exists
-        if os.path.exists(transcript_file_path):
-            os.remove(video_path)
-            return
 
-        # If audio for this video does not already exist, extract it.
-        audio_path = get_audio_path(video_path)
-        if not os.path.exists(audio_path):
-            audio_path = extract_audio(video_path)
+        pending = PendingTranscript(transcript_file_path)
+        if self.transcriber.requires_local_audio():
+            # Local transcribers work from the decoded audio in memory, so
+            # no intermediate audio file is written.
+            pending.audio = decode_audio(video_path)
+        else:
+            # If audio for this video does not already exist, extract it.
+            audio_path = get_audio_path(video_path)
+            if audio_path not in self.existing_upload_audio:
+                extract_audio(video_path, audio_path)
+            pending.audio_path = audio_path
 
         # Video no longer needed, remove it.
         os.remove(video_path)
+        if not self.claim_audio(pending):
+            return None
+        return pending
 
-        # Transcribe the generated audio file.
-        transcript = self.transcriber.transcribe(None, audio_path)
-
-        # Save the new transcript and _maybe_ index it, if relevant.
-        self.save_and_index_transcript(transcript_file_path, transcript)
-
-        # No need to take up disk space with the audio file
-        # once we have the transcript saved
-        if audio_path:
-            os.remove(audio_path)
+    def prepare_recording(self, recording: Recording) -> PendingTranscript:
+        """Retrieves the access link for a Daily cloud recording and,
+        if the transcriber requires it, decodes its audio."""
 
-    def transcribe_and_index_recording(self, recording: Recording):
-        """Transcribes and indexes a Daily cloud recording"""
-
-        print("Transcribing and indexing recording:", recording)
+        log.debug("Preparing recording: %s", recording)
         # A safety rail to make sure we only include relevant room name
         # In reality, we specify the room name when querying Daily's REST API
         if self.daily_room_name and self.daily_room_name != recording.room_name:
-            return
+            return None
 
-        file_name = f"{recording.timestamp}_{recording.room_name}_{recording.id}"
+        file_name = get_recording_file_name(recording)
         transcript_file_path = self.config.get_transcript_file_path(file_name)
 
-        # Don't re-transcribe if a transcript for this recording already exists
-        if os.path.exists(transcript_file_path):
-            return
-
         c = self.config
         recording_url = get_access_link(
             c.daily_api_key, recording.id, c.daily_api_url)
-        audio_path = None
+        pending = PendingTranscript(transcript_file_path, recording_url)
 
-        # If the configured transcriber requires a local
-        # audio file to be sent, make sure it exists.
+        # If the configured transcriber requires local audio,
+        # decode it from the recording.
         if self.transcriber.requires_local_audio():
-            audio_path = self.config.get_remote_recording_audio_path(file_name)
-            if not os.path.exists(audio_path):
-                print("Producing local audio for recording:", recording)
-                audio_path = produce_local_audio_from_url(
-                    recording_url, file_name)
+            log.debug("Decoding audio for recording: %s", recording)
+            pending.audio = decode_audio_from_url(
+                recording_url, file_name, c.recordings_dir_path)
+
+        if not self.claim_audio(pending):
+            return None
+        return pending
+
+    def claim_audio(self, pending: PendingTranscript) -> bool:
+        """Claims the hash of the pending video's local audio, if any.
+        Returns False, and removes the audio, if the same audio has already
+        been transcribed or is being transcribed right now."""
+        if pending.audio is not None:
+            audio_hash = hash_audio(pending.audio)
+        elif pending.audio_path:
+            audio_hash = hash_file(pending.audio_path)
+        else:
+            return True
+        with self.audio_hashes_lock:
+            existing = self.audio_hashes.get(audio_hash)
+            if existing is not None and not os.path.exists(existing):
+                # The transcript has been deleted since, so transcribe
+                # the audio again.
+                del self.audio_hashes[audio_hash]
+                existing = None
+            if existing is None:
+                existing = self.claimed_audio_hashes.get(audio_hash)
+            if existing is None:
+                pending.audio_hash = audio_hash
+                self.claimed_audio_hashes[audio_hash] = \
+                    pending.transcript_file_path
+                return True
+            self.duplicate_transcripts[pending.transcript_file_path] = existing
+        log.info("Audio already transcribed, skipping: %s %s",
+                 pending.transcript_file_path, existing)
+        if pending.audio_path:
+            os.remove(pending.audio_path)
+        return False
 
+    def release_audio(self, pending: PendingTranscript, transcribed: bool):
+        """Releases the pending video's audio hash claim, recording the hash
+        as transcribed if the transcript has been saved"""
+        if not pending.audio_hash:
+            return
+        with self.audio_hashes_lock:
+            self.claimed_audio_hashes.pop(pending.audio_hash, None)
+            if transcribed:
+                self.audio_hashes[pending.audio_hash] = \
+                    pending.transcript_file_path
+
+    def save_audio_hashes(self):
+        """Persists the audio hashes of all transcribed videos, along with
+        the videos found to duplicate them"""
+        with self.audio_hashes_lock:
+            data = orjson.dumps({"hashes": self.audio_hashes,
+                                 "duplicates": self.duplicate_transcripts})
+        # Write to a temporary file and move it into place, so that a crash
+        # mid-write never leaves a partially written file behind.
+        file_path = self.config.audio_hashes_file_path
+        tmp_file_path = f"{file_path}.tmp"
+        with open(tmp_file_path, 'wb') as f:
+            f.write(data)
+        os.replace(tmp_file_path, file_path)
+
+    def transcribe_pending(
+            self, pending: PendingTranscript) -> PendingTranscript:
+        """Transcribes a video whose audio has been prepared and saves
+        the transcript"""
+        recording_url = pending.recording_url
+        audio = pending.audio
+        if audio is not None:
+            # Only convert to float32 samples now, and let go of the int16
+            # samples, so that audio waiting in the pipeline takes half the
+            # memory.
+            audio = to_float_audio(audio)
+            pending.audio = None
         try:
-            print(
-                f"Transcribing video with {self.transcriber}",
-                recording_url,
-                audio_path)
-            transcript = self.transcriber.transcribe(recording_url, audio_path)
+            log.debug("Transcribing video with %s: %s %s", self.transcriber,
+                      recording_url, pending.audio_path)
+            pending.transcript = self.transcriber.transcribe(
+                recording_url, pending.audio_path, audio)
         except Exception as e:
             s = str(e)
             if "413" in s:
                 # The payload was too large - log and skip
-                print(
-                    f"Recording {recording_url} was too large; if you want to index it, "
-                    f"download the recording and "
-                    f"upload in multiple parts")
+                log.warning(
+                    "Recording %s was too large; if you want to index it, "
+                    "download the recording and "
+                    "upload in multiple parts", recording_url)
             else:
-                print(
-                    f"Failed to transcribe video, moving on to the next {recording_url}: {s}")
-            return
-
-        self.save_and_index_transcript(transcript_file_path, transcript)
+                log.warning(
+                    "Failed to transcribe video, moving on to the next %s: %s",
+                    recording_url, s)
+            # Allow this audio to be transcribed again later.
+            self.release_audio(pending, transcribed=False)
+            return None
+
+        # The decoded audio is no longer needed.
+        audio = None
+
+        # Save the transcript from this stage's worker, so that the single
+        # index worker spends its time on indexing alone.
+        with open(pending.transcript_file_path, 'w+', encoding='utf-8') as f:
+            f.write(pending.transcript)
+        self.release_audio(pending, transcribed=True)
 
         # No need to take up disk space once we have the transcript
-        if audio_path:
-            os.remove(audio_path)
+        if pending.audio_path:
+            os.remove(pending.audio_path)
 
-    def save_and_index_transcript(
-            self,
-            transcript_file_path: str,
-            transcript: str):
-        """Save the given transcript and index it if the store is ready"""
-
-        # Save transcript to given file path
-        with open(transcript_file_path, 'w+', encoding='utf-8') as f:
-            f.write(transcript)
-            # If the index has been loaded, go ahead and index this transcript
-            if self.ready() is True:
-                print("Indexing transcript:", transcript_file_path)
-                doc = Document(text=transcript)
-                self.index.insert(doc)
+        return pending
+
+    def index_pending(self, pending: PendingTranscript):
+        """Indexes a transcribed video, or keeps it for index creation
+        if there is no index yet."""
+        if not self.ready():
+            self.pending_documents.append(Document(text=pending.transcript))
+            self.new_transcript_paths.add(pending.transcript_file_path)
+            return
+        self.index_transcript(pending.transcript)
+
+    def index_transcript(self, transcript: str):
+        """Queues the given transcript for indexing if the store is ready"""
+        # If the index has been loaded, go ahead and index this transcript
+        if self.ready() is True:
+            now = time.monotonic()
+            if not self.pending_documents:
+                self.pending_since = now
+            self.pending_documents.append(Document(text=transcript))
+            if len(self.pending_documents) >= self.index_batch_size or \
+                    now - self.pending_since >= self.index_flush_interval:
+                self.flush_documents()
+
+    def flush_due_in(self) -> float:
+        """Returns the number of seconds until pending documents are due to
+        be inserted into the index, or None if there are none to insert"""
+        if not self.pending_documents or not self.ready():
+            return None
+        return max(0.0, self.pending_since + self.index_flush_interval
+                   - time.monotonic())
+
+    def flush_documents(self):
+        """Inserts all pending documents into the index in one batch"""
+        docs = self.pending_documents
+        if not docs or not self.ready():
+            return
+        self.pending_documents = []
+        log.info("Indexing transcripts: %d", len(docs))
+        nodes = self.index.service_context.node_parser.get_nodes_from_documents(
+            docs)
+        self.index.insert_nodes(nodes)
+        self.vector_cache.add_from_collection(
+            self.index.vector_store.client, [n.node_id for n in nodes])
+        for doc in docs:
+            self.index.docstore.set_document_hash(doc.get_doc_id(), doc.hash)
+        self.index_changed = True
 
     def get_vector_store(self):
-        """Returns vector store with desired Chroma client, collection, and embed model"""
-        chroma_client = chromadb.PersistentClient(
-            path=self.config.index_dir_path)
+        """Returns vector store with desired Chroma client and collection"""
+        chroma_client = get_chroma_client(self.config.index_dir_path)
         chroma_collection = chroma_client.get_or_create_collection(
             self.collection_name)
-        embed_model = HuggingFaceEmbedding(model_name="BAAI/bge-base-en-v1.5")
-        vector_store = ChromaVectorStore(
-            chroma_collection=chroma_collection, embed_model=embed_model)
+        vector_store = ChromaVectorStore(chroma_collection=chroma_collection)
         return vector_store
 
+    def get_service_context(self) -> ServiceContext:
+        """Returns service context with the desired embed model"""
+        return ServiceContext.from_defaults(
+            embed_model=get_embed_model(
+                self.config.embedding_cache_file_path,
+                self.config.embed_compile))
+
     def ready(self) -> bool:
         """Returns a boolean indicating whether the index is ready to query"""
         return self.index is not None
@@ -334,8 +751,9 @@ class Store:
         if state is not None:
             self.status.state = state
         self.status.message = message
+        self.status_version += 1
 
     def destroy(self):
         """Destroy cleans up and shuts down relevant store operations"""
         for executor in self.executors:
-            executor.shutdown(kill_workers=True, wait=False)
+            executor.shutdown(wait=False, cancel_futures=True)
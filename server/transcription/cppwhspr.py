@@ -0,0 +1,58 @@
+"""This module implements Whisper transcription with a locally-downloaded
+whisper.cpp (ggml) model."""
+import os
+import threading
+
+import numpy as np
+from pywhispercpp.model import Model
+
+from .transcriber import Transcriber
+
+
+class WhisperCppTranscriber(Transcriber):
+    """Class to transcribe an audio file with a locally-downloaded
+    whisper.cpp model"""
+    model_name = "base"
+    # Directory the ggml model is downloaded to.
+    models_dir: str = None
+    _model: Model = None
+    _lock: threading.Lock = None
+
+    def __init__(self, model_name: str = None, models_dir: str = None):
+        if model_name:
+            self.model_name = model_name
+        self.models_dir = models_dir
+        self._lock = threading.Lock()
+
+    def requires_local_audio(self) -> bool:
+        return True
+
+    def max_concurrency(self) -> int:
+        # A whisper.cpp context only runs one transcription at a time, and
+        # that transcription already uses every core.
+        return 1
+
+    def get_model(self) -> Model:
+        """Returns the whisper.cpp model, loading it on first use only"""
+        with self._lock:
+            if not self._model:
+                self._model = Model(self.model_name,
+                                    models_dir=self.models_dir,
+                                    n_threads=os.cpu_count() or 1)
+            return self._model
+
+    def transcribe(self, recording_url: str = None,
+                   audio_path: str = None, audio: np.ndarray = None) -> str:
+        """Transcribes given audio or audio file using whisper.cpp"""
+        if audio is None:
+            audio = audio_path
+        model = self.get_model()
+        with self._lock:
+            segments = model.transcribe(audio)
+        return "".join(segment.text for segment in segments)
+
+    def warmup(self):
+        """Loads the model and runs it on a second of silence"""
+        model = self.get_model()
+        with self._lock:
+            model.transcribe(np.zeros(16000, dtype=np.float32))
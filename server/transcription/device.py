@@ -0,0 +1,48 @@
+"""Module selecting the device, compute type, and default model local
+transcription models run with."""
+import torch
+
+
+class Models:
+    """Class of basic Whisper model selection options, as plain strings"""
+    TINY = "tiny"
+    BASE = "base"
+    MEDIUM = "medium"
+    LARGE_V3_TURBO = "large-v3-turbo"
+    NBAILAB_LARGE_V2 = "NbAiLab/whisper-large-v2-nob"
+
+
+def pick_device_and_compute_type() -> tuple[str, str]:
+    """Returns the device to run a local model on, and the CTranslate2
+    compute type which suits it best"""
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    return device, pick_compute_type(device)
+
+
+def pick_compute_type(device: str) -> str:
+    """Returns the CTranslate2 compute type which suits the given device
+    best, or "default" to leave it to CTranslate2 for unknown devices"""
+    if device == "cpu":
+        return "int8"
+    if not device.startswith("cuda"):
+        return "default"
+    major, minor = torch.cuda.get_device_capability(device)
+    capability = major + minor / 10
+    if capability >= 8.0:
+        # Ampere and newer run int8 matrix products on tensor cores.
+        return "int8_float16"
+    if capability >= 7.0:
+        # Volta and Turing have float16 tensor cores.
+        return "float16"
+    if capability >= 6.1:
+        return "int8"
+    return "float32"
+
+
+def pick_model_name(device: str) -> str:
+    """Returns the default Whisper model for the given device. On GPU,
+    large-v3-turbo, whose decoder has only 4 layers, transcribes about as
+    fast as base while making far fewer mistakes."""
+    if device.startswith("cuda"):
+        return Models.LARGE_V3_TURBO
+    return Models.BASE
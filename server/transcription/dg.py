@@ -1,81 +1,115 @@
 """This module implements Deepgram transcription
 """
-import os
+import logging
 
-from deepgram import Deepgram
+import numpy as np
+import orjson
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 
 from .transcriber import Transcriber
 
+log = logging.getLogger(__name__)
+
+DEEPGRAM_LISTEN_URL = "https://api.deepgram.com/v1/listen"
+# Connect and read timeouts of transcription requests, in seconds. Deepgram
+# only responds once the whole recording is transcribed, so reads are
+# given several minutes.
+DEEPGRAM_TIMEOUT = (10, 600)
+
+# Use a single session to persist HTTP connections to Deepgram across
+# transcriptions, avoiding a new TCP and TLS handshake per request. The
+# pool is sized for many concurrent transcriptions. Failed connections and
+# transient server errors are retried with backoff, but requests which may
+# have reached Deepgram are not sent again. Responses with an error status
+# are returned once retries run out, so that their status is reported.
+session = requests.Session()
+session.mount('https://', HTTPAdapter(
+    pool_connections=1,
+    pool_maxsize=32,
+    max_retries=Retry(
+        total=3,
+        read=0,
+        backoff_factor=0.5,
+        status_forcelist=[429, 502, 503, 504],
+        allowed_methods=["POST"],
+        respect_retry_after_header=True,
+        raise_on_status=False)))
+
 
 class DeepgramTranscriber(Transcriber):
     """Class to transcribe a recording from either a local audio file
     or a remote URL with Deepgram"""
     api_key = None
     model_name = None
+    # Query parameters and headers of transcription requests.
+    params: dict = None
+    headers: dict = None
 
     def __init__(self, api_key: str, model_name: str):
+        # Fail when the transcriber is created, not on every transcription.
+        if not api_key:
+            raise Exception("Deepgram API key is missing")
         self.api_key = api_key
         self.model_name = model_name
         if not self.model_name:
             self.model_name = "nova"
-
-    def requires_local_audio(self) -> bool:
-        return False
-
-    def get_transcription_options(self):
-        """Compiles the Deepgram transfiguration config"""
-        return {
+        # Create the request options once and reuse them for every
+        # transcription.
+        self.params = {
             "model": self.model_name,
-            "filler_words": True,
+            "filler_words": "true",
             "language": "en",
         }
+        self.headers = {"Authorization": f"Token {api_key}"}
+
+    def requires_local_audio(self) -> bool:
+        return False
 
     def transcribe(self, recording_url: str = None,
-                   audio_path: str = None) -> str:
+                   audio_path: str = None, audio: np.ndarray = None) -> str:
         """Transcribes give audio file or recording URL"""
-        deepgram_api_key = self.api_key
-        if not deepgram_api_key:
-            raise Exception("Deepgram API key is missing")
         if not recording_url and not audio_path:
             raise Exception(
                 "Either recording URL or local audio path must be specified")
 
         if recording_url and audio_path:
-            print(
+            log.debug(
                 "Both recording URL and audio path specified. Favoring local audio path.")
 
         if audio_path:
-            return self.transcribe_from_file(deepgram_api_key, audio_path)
-        return self.transcribe_from_url(deepgram_api_key, recording_url)
+            return self.transcribe_from_file(audio_path)
+        return self.transcribe_from_url(recording_url)
 
-    def transcribe_from_url(self, api_key: str, recording_url: str) -> str:
+    def transcribe_from_url(self, recording_url: str) -> str:
         """Transcribers recording from URL."""
-        print("transcribing from URL:", recording_url)
-        deepgram = Deepgram(api_key)
-        source = {'url': recording_url}
-        res = deepgram.transcription.sync_prerecorded(
-            source, self.get_transcription_options()
-        )
-        return self.get_transcript(res)
-
-    def transcribe_from_file(self, api_key: str, audio_path: str) -> str:
+        log.debug("transcribing from URL: %s", recording_url)
+        return self.post_listen(
+            orjson.dumps({'url': recording_url}), "application/json")
+
+    def transcribe_from_file(self, audio_path: str) -> str:
         """Transcribes recording from audio file."""
-        if audio_path and not os.path.exists(audio_path):
-            raise Exception("Audio file could not be found", audio_path)
-        deepgram = Deepgram(api_key)
+        try:
+            audio_file = open(audio_path, 'rb')
+        except FileNotFoundError as e:
+            raise Exception("Audio file could not be found", audio_path) from e
+        # Stream the file from disk as the request body, with its length
+        # known up front.
+        with audio_file:
+            return self.post_listen(audio_file, "audio/wav")
 
-        with open(audio_path, 'rb') as audio_file:
-            source = {'buffer': audio_file, 'mimetype': "audio/wav"}
-            res = deepgram.transcription.sync_prerecorded(
-                source, self.get_transcription_options()
-            )
-        return self.get_transcript(res)
+    def post_listen(self, data, content_type: str) -> str:
+        """Sends the given request body to Deepgram's pre-recorded
+        transcription endpoint and returns the transcript"""
+        res = session.post(DEEPGRAM_LISTEN_URL, params=self.params,
+                           headers={**self.headers, "Content-Type": content_type},
+                           data=data, timeout=DEEPGRAM_TIMEOUT)
+        if not res.ok:
+            raise Exception(
+                f'Failed to transcribe audio; return code {res.status_code}; {res.text}')
+        return self.get_transcript(orjson.loads(res.content))
 
     def get_transcript(self, result) -> str:
         """Retrieves transcript string from Deepgram result"""
-        res = result["results"]
-        channels = res["channels"]
-        channel = channels[0]
-        alts = channel["alternatives"]
-        alt = alts[0]
-        return alt["transcript"]
+        return result["results"]["channels"][0]["alternatives"][0]["transcript"]
@@ -0,0 +1,140 @@
+"""This module implements batched Whisper transcription with a locally-downloaded
+faster-whisper (CTranslate2) model."""
+import logging
+import os
+import shutil
+import threading
+
+import numpy as np
+from ctranslate2.converters import TransformersConverter
+from faster_whisper import BatchedInferencePipeline, WhisperModel
+
+from .device import pick_compute_type, pick_device_and_compute_type, \
+    pick_model_name
+from .transcriber import Transcriber
+
+log = logging.getLogger(__name__)
+
+# Compute types which models can be converted to ahead of time. Others,
+# such as "default", are resolved by CTranslate2 when the model loads.
+CONVERTIBLE_COMPUTE_TYPES = {
+    "int8", "int8_float32", "int8_float16", "int8_bfloat16", "int16",
+    "float16", "bfloat16", "float32"}
+
+
+class FasterWhisperTranscriber(Transcriber):
+    """Class to transcribe an audio file with a locally-downloaded
+    faster-whisper model, decoding chunks of each file in batches"""
+    model_name: str = None
+    batch_size = 16
+    num_workers = 2
+    device: str = None
+    compute_type: str = None
+    # Directory holding models converted to CTranslate2 weights quantized
+    # to their compute type.
+    models_dir: str = None
+    _pipeline: BatchedInferencePipeline = None
+    _lock: threading.Lock = None
+
+    def __init__(self, model_name: str = None, batch_size: int = None,
+                 num_workers: int = None, device: str = None,
+                 compute_type: str = None, models_dir: str = None):
+        if batch_size:
+            self.batch_size = batch_size
+        if num_workers:
+            self.num_workers = num_workers
+        # Use the GPU if there is one, unless told otherwise.
+        self.device = device or pick_device_and_compute_type()[0]
+        # Pick the compute type for the device actually used, which may not
+        # be the one detected, e.g. when the CPU is requested on a GPU host.
+        self.compute_type = compute_type or pick_compute_type(self.device)
+        self.model_name = model_name or pick_model_name(self.device)
+        self.models_dir = models_dir
+        self._lock = threading.Lock()
+
+    def requires_local_audio(self) -> bool:
+        return True
+
+    def get_pipeline(self) -> BatchedInferencePipeline:
+        """Returns the batched inference pipeline, loading the model
+        on first use only"""
+        with self._lock:
+            if not self._pipeline:
+                # Each worker lets one more transcription use the model
+                # at the same time, and the CPU cores are split between
+                # them rather than CTranslate2's default of four threads.
+                model = WhisperModel(
+                    self.get_model_path(),
+                    device=self.device,
+                    compute_type=self.compute_type,
+                    cpu_threads=max(
+                        1, (os.cpu_count() or 1) // self.num_workers),
+                    num_workers=self.num_workers)
+                self._pipeline = BatchedInferencePipeline(model=model)
+            return self._pipeline
+
+    def get_model_path(self) -> str:
+        """Returns the path of the model converted to this transcriber's
+        compute type in the models directory, converting the model on first
+        use. Returns the model name, for faster-whisper to download, if there
+        is no models directory or the compute type is not a concrete one."""
+        if not self.models_dir or \
+                self.compute_type not in CONVERTIBLE_COMPUTE_TYPES:
+            return self.model_name
+        path = get_converted_model_path(
+            self.models_dir, self.model_name, self.compute_type)
+        if not os.path.isdir(path):
+            convert_model(self.model_name, path, self.compute_type)
+        return path
+
+    def transcribe(self, recording_url: str = None,
+                   audio_path: str = None, audio: np.ndarray = None) -> str:
+        """Transcribes given audio or audio file using faster-whisper"""
+        if audio is None:
+            audio = audio_path
+        # The audio is split into speech chunks, which are decoded
+        # batch_size at a time rather than one after the other.
+        # Decode greedily, like the reference Whisper implementation does
+        # by default.
+        segments, _ = self.get_pipeline().transcribe(
+            audio, batch_size=self.batch_size, beam_size=1)
+        return "".join(segment.text for segment in segments)
+
+    def warmup(self):
+        """Loads the model and runs it on a second of silence"""
+        # The batched pipeline would filter the silence out before it
+        # reaches the model, so call the model directly.
+        segments, _ = self.get_pipeline().model.transcribe(
+            np.zeros(16000, dtype=np.float32), beam_size=1)
+        list(segments)
+
+
+def get_converted_model_path(models_dir: str, model_name: str,
+                             quantization: str) -> str:
+    """Returns the path of the given model's weights, quantized as given,
+    in the given models directory"""
+    return os.path.join(
+        models_dir, f"{model_name.replace('/', '--')}-{quantization}")
+
+
+def convert_model(model_name: str, output_dir: str, quantization: str):
+    """Converts the given Whisper model from the Hugging Face Hub to
+    CTranslate2 weights quantized as given. Weights stored in the compute
+    type they run with load without conversion, and int8 weights are a
+    quarter of the size of the original weights."""
+    # Plain model sizes refer to OpenAI's models.
+    if "/" not in model_name:
+        model_name = f"openai/whisper-{model_name}"
+    log.info("Converting Whisper model %s to %s weights in %s",
+             model_name, quantization, output_dir)
+    converter = TransformersConverter(
+        model_name,
+        copy_files=["tokenizer.json", "preprocessor_config.json"])
+    # Convert into a temporary directory, so that a model directory
+    # always holds a complete conversion.
+    tmp_dir = f"{output_dir}.part"
+    try:
+        converter.convert(tmp_dir, quantization=quantization, force=True)
+        os.replace(tmp_dir, output_dir)
+    finally:
+        shutil.rmtree(tmp_dir, ignore_errors=True)
@@ -1,6 +1,8 @@
 """Module defining a transcriber base class, which new transcribers can implement"""
 from abc import ABC, abstractmethod
 
+import numpy as np
+
 
 class Transcriber(ABC):
     """Abstract class defining methods that should be implemented by any transcriber"""
@@ -11,5 +13,15 @@ class Transcriber(ABC):
 
     @abstractmethod
     def transcribe(self, recording_url: str = None,
-                   audio_path: str = None) -> str:
-        """Returns a transcription string"""
+                   audio_path: str = None, audio: np.ndarray = None) -> str:
+        """Returns a transcription string. Transcribers which require local
+        audio are given the decoded 16kHz mono audio, if it is available."""
+
+    def max_concurrency(self) -> int:
+        """Returns how many transcriptions this transcriber can usefully
+        run at once, or None to leave it to the caller."""
+        return None
+
+    def warmup(self):
+        """Loads and exercises any local model ahead of the first
+        transcription. Does nothing by default."""
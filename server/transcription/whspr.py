@@ -1,31 +1,105 @@
 """This module implements Whisper transcription with a locally-downloaded model."""
-from enum import Enum
+import threading
 
+import numpy as np
+import torch
 import whisper
-from .transcriber import Transcriber
-
 
-class Models(Enum):
-    """Class of basic Whisper model selection options"""
-    TINY = "tiny"
-    BASE = "base"
-    MEDIUM = "medium"
-    NBAILAB_LARGE_V2 = "NbAiLab/whisper-large-v2-nob"
+from .device import Models, pick_device_and_compute_type, pick_model_name
+from .transcriber import Transcriber
 
 
 class WhisperTranscriber(Transcriber):
     """Class to transcribe an audio file with a locally-downloaded Whisper model"""
+    # Loaded models, shared by all transcribers, by model name, device,
+    # and whether the model is compiled.
+    # Each model comes with a lock, since Whisper installs per-call hooks
+    # on the model while decoding, so it can only be used by one
+    # transcription at a time.
+    _models: dict[tuple[str, str, bool],
+                  tuple[whisper.Whisper, threading.Lock]] = {}
+    _models_lock = threading.Lock()
+
+    model_name = Models.BASE
+    device: str = None
+    compile_model: bool = False
+    # Whether to drop non-speech from audio before transcribing it.
+    trim_silence: bool = False
+
+    def __init__(self, device: str = None, compile_model: bool = False,
+                 model_name: str = None, trim_silence: bool = False):
+        # Use the GPU if there is one, unless told otherwise.
+        self.device = device or pick_device_and_compute_type()[0]
+        self.model_name = model_name or pick_model_name(self.device)
+        self.compile_model = compile_model
+        self.trim_silence = trim_silence
 
     def requires_local_audio(self) -> bool:
         return True
 
+    def max_concurrency(self) -> int:
+        # Transcriptions take turns on the model anyway, so a second one
+        # would only hold its decoded audio in memory while it waits.
+        return 1
+
+    @classmethod
+    def get_model(cls, name: str, device: str,
+                  compile_model: bool = False
+                  ) -> tuple[whisper.Whisper, threading.Lock]:
+        """Returns the given Whisper model and its lock, loading the model
+        on first use only"""
+        key = (name, device, compile_model)
+        with cls._models_lock:
+            if key not in cls._models:
+                model = whisper.load_model(name, device=device).eval()
+                if compile_model:
+                    # The encoder always sees 30-second windows, so it
+                    # compiles to a single graph. The decoder is left as is,
+                    # since Whisper hooks into its layers for every decode.
+                    model.encoder = torch.compile(model.encoder)
+                cls._models[key] = (model, threading.Lock())
+            return cls._models[key]
+
+    def get_own_model(self) -> tuple[whisper.Whisper, threading.Lock]:
+        """Returns this transcriber's Whisper model and its lock"""
+        return self.get_model(self.model_name, self.device, self.compile_model)
+
     def transcribe(self, recording_url: str = None,
-                   audio_path: str = None) -> str:
-        """Transcribes given audio file using Whisper"""
-        audio = whisper.load_audio(audio_path)
-        model = whisper.load_model(Models.BASE.value, device="cpu")
-        transcription = whisper.transcribe(
-            model,
-            audio
-        )
+                   audio_path: str = None, audio: np.ndarray = None) -> str:
+        """Transcribes given audio or audio file using Whisper"""
+        if audio is None:
+            audio = whisper.load_audio(audio_path)
+        if self.trim_silence:
+            audio = trim_non_speech(audio)
+            if not audio.size:
+                return ""
+        model, lock = self.get_own_model()
+        with lock:
+            transcription = whisper.transcribe(
+                model,
+                audio
+            )
         return transcription["text"]
+
+    def warmup(self):
+        """Loads the model and runs it on a second of silence"""
+        model, lock = self.get_own_model()
+        with lock:
+            whisper.transcribe(model, np.zeros(16000, dtype=np.float32))
+
+
+def trim_non_speech(audio: np.ndarray) -> np.ndarray:
+    """Returns only the speech in the given 16kHz audio, as detected by
+    the Silero VAD model bundled with faster-whisper. Whisper encodes
+    every 30-second window it is given, so dropping silence up front
+    saves encoder passes. Speech on either side of a dropped gap is
+    transcribed as if it were contiguous, so segment timestamps no longer
+    match the original audio."""
+    # Only needed when trimming, so that the reference implementation
+    # does not otherwise depend on faster-whisper.
+    # pylint: disable-next=import-outside-toplevel
+    from faster_whisper.vad import get_speech_timestamps
+    timestamps = get_speech_timestamps(audio)
+    if not timestamps:
+        return audio[:0]
+    return np.concatenate([audio[t["start"]:t["end"]] for t in timestamps])
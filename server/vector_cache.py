@@ -0,0 +1,133 @@
+"""Module providing an in-memory copy of the indexed chunk embeddings, so that
+queries over small indexes can be answered without going through Chroma."""
+import threading
+
+import numpy as np
+from llama_index.constants import DEFAULT_SIMILARITY_TOP_K
+from llama_index.embeddings.base import BaseEmbedding
+from llama_index.indices.base_retriever import BaseRetriever
+from llama_index.schema import NodeWithScore, QueryBundle
+from llama_index.vector_stores.utils import metadata_dict_to_node
+
+
+class VectorCache:
+    """Class holding the embeddings, texts, and metadata of indexed chunks
+    in memory, and scoring them against query embeddings."""
+    # Indexes with more chunks than this are queried through Chroma.
+    max_chunks = 100_000
+    # Embeddings are held in half precision to halve their memory use.
+    # NumPy has no fast half-precision matrix product, so they are scored
+    # in blocks of this many rows, each converted to single precision.
+    score_block_size = 8192
+
+    _embeddings: np.ndarray = None
+    _texts: list[str] = None
+    _metadatas: list[dict] = None
+    # Whether the index has outgrown the cache. Chunks are no longer cached
+    # once it has, until the cache is cleared.
+    _overflowed: bool = False
+    _lock: threading.Lock = None
+
+    def __init__(self):
+        self._texts = []
+        self._metadatas = []
+        self._lock = threading.Lock()
+
+    def ready(self) -> bool:
+        """Returns whether queries can be answered from the cache"""
+        embeddings = self._embeddings
+        return not self._overflowed and embeddings is not None \
+            and len(embeddings) > 0
+
+    def clear(self):
+        """Removes all cached chunks"""
+        with self._lock:
+            self._embeddings = None
+            self._texts = []
+            self._metadatas = []
+            self._overflowed = False
+
+    def add_from_collection(self, collection, ids: list[str] = None):
+        """Caches the chunks with the given IDs from the given Chroma
+        collection, or all of the collection's chunks if no IDs are given.
+        If the chunks would take the cache past its maximum size, the cache
+        is emptied and stops caching chunks instead, without fetching them."""
+        count = collection.count() if ids is None else len(ids)
+        with self._lock:
+            if self._overflowed:
+                return
+            if len(self._texts) + count > self.max_chunks:
+                self._overflowed = True
+                self._embeddings = None
+                self._texts = []
+                self._metadatas = []
+                return
+        res = collection.get(
+            ids=ids, include=["embeddings", "documents", "metadatas"])
+        if not res["ids"]:
+            return
+        embeddings = np.asarray(res["embeddings"], dtype=np.float32)
+        # Normalize so that a dot product gives the cosine similarity.
+        embeddings /= np.linalg.norm(embeddings, axis=1, keepdims=True)
+        embeddings = embeddings.astype(np.float16)
+
+        with self._lock:
+            if self._embeddings is not None:
+                embeddings = np.vstack((self._embeddings, embeddings))
+            # Grow the texts and metadata before the embeddings, so that
+            # concurrent queries never see an embedding without its text.
+            self._texts = self._texts + res["documents"]
+            self._metadatas = self._metadatas + res["metadatas"]
+            self._embeddings = embeddings
+
+    def top_k(self, query_embedding: list[float],
+              k: int) -> list[NodeWithScore]:
+        """Returns the k chunks most similar to the given query embedding,
+        most similar first"""
+        # Read the cache once, so that the chunks stay consistent with each
+        # other even if the cache is emptied while scoring.
+        with self._lock:
+            embeddings = self._embeddings
+            texts = self._texts
+            metadatas = self._metadatas
+        if embeddings is None:
+            return []
+        query = np.asarray(query_embedding, dtype=np.float32)
+        query /= np.linalg.norm(query)
+        scores = np.empty(len(embeddings), dtype=np.float32)
+        step = self.score_block_size
+        for start in range(0, len(embeddings), step):
+            block = embeddings[start:start + step].astype(np.float32)
+            np.matmul(block, query, out=scores[start:start + step])
+        # Select the top k in linear time, then sort only those, without
+        # negating the whole scores array.
+        k = min(k, len(scores))
+        top = np.argpartition(scores, len(scores) - k)[-k:]
+        top = top[np.argsort(scores[top])[::-1]]
+        return [get_node(texts[i], metadatas[i], float(scores[i]))
+                for i in top]
+
+
+def get_node(text: str, metadata: dict, score: float) -> NodeWithScore:
+    """Returns the given cached chunk as a node"""
+    node = metadata_dict_to_node(metadata)
+    node.set_content(text)
+    return NodeWithScore(node=node, score=score)
+
+
+class VectorCacheRetriever(BaseRetriever):
+    """Retriever which finds the chunks most similar to a query in the
+    given vector cache"""
+
+    def __init__(self, cache: VectorCache, embed_model: BaseEmbedding,
+                 similarity_top_k: int = DEFAULT_SIMILARITY_TOP_K):
+        self._cache = cache
+        self._embed_model = embed_model
+        self._similarity_top_k = similarity_top_k
+
+    def _retrieve(self, query_bundle: QueryBundle) -> list[NodeWithScore]:
+        query_embedding = query_bundle.embedding
+        if query_embedding is None:
+            query_embedding = self._embed_model.get_agg_embedding_from_queries(
+                query_bundle.embedding_strs)
+        return self._cache.top_k(query_embedding, self._similarity_top_k)